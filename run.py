@@ -6,6 +6,13 @@ Provides a simple automated service to calculate and update sheets:
 - stock: with the advised stock level for the next market
 """
 
+import functools
+import random
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -16,10 +23,61 @@ SCOPE = [
     "https://www.googleapis.com/auth/drive"
 ]
 
-CREDS = Credentials.from_service_account_file("creds.json")
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open("love_sandwiches")
+SALES_PROMPT = (
+    "Please enter sales data form the last market.\n"
+    "Data should be six numbers, separated by commas.\n"
+    "Example: 10,20,30,40,50,60\n\n"
+)
+
+# a whole number, optionally negative
+INT_RE = re.compile(r"\A-?\d+\Z")
+
+# attempts made for a request rejected by the per-minute quota
+MAX_RETRIES = 5
+
+# set when the program is aborted, so pending retries stop early
+_aborted = threading.Event()
+
+
+@functools.lru_cache(None)
+def get_sheet():
+    """Open the love_sandwiches spreadsheet.
+
+    Credentials are read and authorized on first use rather than at
+    import, and the opened spreadsheet is reused for later calls.
+
+    Returns:
+        The gspread Spreadsheet for love_sandwiches.
+    """
+    creds = Credentials.from_service_account_file("creds.json")
+    scoped_creds = creds.with_scopes(SCOPE)
+    gspread_client = gspread.authorize(scoped_creds)
+    return with_backoff(gspread_client.open, "love_sandwiches")
+
+
+def with_backoff(request, *args, **kwargs):
+    """Call a Sheets API request, retrying when the quota is exceeded.
+
+    Google limits requests per user per minute and answers with
+    HTTP 429 when the limit is hit. Waits with a jittered exponential
+    backoff before retrying, unless the program has been aborted.
+
+    Args:
+        request: gspread method making the API call.
+        *args, **kwargs: arguments passed on to `request`.
+
+    Returns:
+        The response of the request.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return request(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 429 or attempt == MAX_RETRIES - 1:
+                raise
+            # returns early, and gives up, if the program is aborted
+            if _aborted.wait(2 ** attempt + random.random()):
+                raise
 
 
 def get_sales_data():
@@ -30,18 +88,17 @@ def get_sales_data():
     by commas. The loop will repeatedly request data until it is valid.
 
     Returns:
-        A list of values generated by user input. List contains strings.
+        A list of values generated by user input. List contains integers.
     """
     while True:
-        print("Please enter sales data form the last market.")
-        print("Data should be six numbers, separated by commas.")
-        print("Example: 10,20,30,40,50,60\n")
+        sys.stdout.write(SALES_PROMPT)
+        sys.stdout.flush()
 
         # !heroku deployment requires newline character at the end of inputs!
         data_str = input("Enter your data here:\n")
-        sales_data = data_str.split(",")
+        sales_data = validate_data(data_str.split(","))
 
-        if validate_data(sales_data):
+        if sales_data is not None:
             break
 
     return sales_data
@@ -50,27 +107,72 @@ def get_sales_data():
 def validate_data(values):
     """Validates Data.
 
-    Inside the try, converts all string values into integers.
-    Raises ValueError if strings cannot be converted into int,
-    or if there aren't exactly 6 values.
+    Checks there are exactly 6 values, then matches each value against
+    `INT_RE` so invalid input is rejected without raising an exception.
+    Only valid values are converted into integers.
 
     Args:
         values: List of values. Should be 6 integers.
 
     Returns:
-        True if validation passes, otherwise False
+        List of the values as integers if validation passes,
+        otherwise None
     """
-    try:
-        [int(value) for value in values]
-        if len(values) != 6:
-            raise ValueError(
-                f"Exactly 6 values required, you provided {len(values)}"
-            )
-    except ValueError as e:
-        print(f"Invalid data: {e}, please try again.\n")
-        return False
+    if len(values) != 6:
+        error = f"Exactly 6 values required, you provided {len(values)}"
+    else:
+        error = next(
+            (
+                f"{value.strip()!r} is not a whole number"
+                for value in values
+                if not INT_RE.match(value.strip())
+            ),
+            None,
+        )
+
+    if error is not None:
+        print(f"Invalid data: {error}, please try again.\n")
+        return None
+    return [int(value) for value in values]
+
+
+def prefetch() -> dict:
+    """Read everything the calculations need in a single batch request.
+
+    Collects the sales and stock worksheets with one batchGet, then
+    picks out the last row of the stock worksheet and the last five
+    sales entries. Row numbers are not resolved here, as rows are
+    appended server-side when written.
+
+    The API trims trailing blank cells from each row, so a short row
+    would silently drop sandwiches from the calculations. Raises
+    ValueError instead if any row used has a blank cell or fewer than
+    6 values.
 
-    return True
+    Returns:
+        A dict with the keys:
+        - stock_last_row: latest stock entry as string values
+        - sales_last5_cols: a list for each sandwich holding the latest
+          5 sales entries as string values
+    """
+    sales, stock = (
+        value_range.get("values", [])
+        for value_range in with_backoff(
+            get_sheet().values_batch_get,
+            ["sales!A:F", "stock!A:F"],
+            params={"majorDimension": "ROWS"},
+        )["valueRanges"]
+    )
+    if not sales or not stock:
+        raise ValueError("sales and stock worksheets must not be empty")
+    for row in sales[-5:] + stock[-1:]:
+        if len(row) != 6 or "" in row:
+            raise ValueError(f"Expected 6 values per row, found {row}")
+
+    return {
+        "stock_last_row": stock[-1],
+        "sales_last5_cols": [list(column) for column in zip(*sales[-5:])],
+    }
 
 
 def update_worksheet(data: list, worksheet: str):
@@ -85,12 +187,29 @@ def update_worksheet(data: list, worksheet: str):
         worksheet : name of the worksheet to be updated
     """
     print(f"Updating {worksheet} worksheet...\n")
-    current_worksheet = SHEET.worksheet(worksheet)
-    current_worksheet.append_row(data)
+    append_worksheet_row(data, worksheet)
     print(f"{worksheet} worksheet updated successfully.\n".capitalize())
 
 
-def calculate_surplus_data(sales_row):
+def append_worksheet_row(data: list, worksheet: str):
+    """Appends a row of integers to a worksheet in a single request.
+
+    The values.append endpoint finds the end of the table and inserts
+    the row server-side, so concurrent runs never write to the same row.
+
+    Args:
+        data : data list to be appended to a worksheet
+        worksheet : name of the worksheet to be updated
+    """
+    with_backoff(
+        get_sheet().values_append,
+        f"{worksheet}!A:F",
+        params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        body={"values": [data]},
+    )
+
+
+def calculate_surplus_data(sales_row, stock_row):
     """Calculate surplus stock values.
 
     Compare sales with stock and calculate the surplus for each item type.
@@ -101,36 +220,17 @@ def calculate_surplus_data(sales_row):
 
     Args:
         sales_row: List of 6 integers generated from `get_sales_data()`.
+        stock_row: Latest stock entry, from `prefetch()`.
 
     Returns:
         List containing 6 values showing stock - sales.
     """
     print("Calculating surplus data...\n")
-    stock = SHEET.worksheet("stock").get_all_values()
-    stock_row = stock[-1]
-    stock_row_data = [int(num) for num in stock_row]
-    surplus_data = [x - y for x, y, in zip(stock_row_data, sales_row)]
+    surplus_data = [int(x) - y for x, y in zip(stock_row, sales_row)]
 
     return surplus_data
 
 
-def get_last_5_entries_sales() -> list[list[str]]:
-    """Retrieve sales data for last 5 entries.
-
-    Collects columns of data from sales worksheet, collectings the
-    last five entries for each sandwich and returns the data as a
-    list of lists.
-
-    Returns:
-        A list of lists. Each list contains the latest 5 sales entries as
-        string values.
-    """
-    sales = SHEET.worksheet("sales")
-    # !index for gspread starts at 1!!
-    columns = [sales.col_values(column)[-5:] for column in range(1, 7)]
-    return columns
-
-
 def calculate_stock_data(data):
     """Calculate the average stock used over the previous 5 markets.
 
@@ -142,13 +242,9 @@ def calculate_stock_data(data):
     """
 
     print("Calculating stock data...\n")
-    new_stock_data = []
-
-    for column in data:
-        int_column = [int(num) for num in column]
-        average = sum(int_column) / len(int_column)
-        stock_num = average * 1.1
-        new_stock_data.append(round(stock_num))
+    new_stock_data = [
+        round(sum(map(int, column)) / len(column) * 1.1) for column in data
+    ]
 
     return new_stock_data
 
@@ -157,15 +253,35 @@ def main():
     """
     Run all program functions
     """
-    data = get_sales_data()
-    sales_data = [int(num) for num in data]
+    # authorize and open the spreadsheet before prompting, so a bad
+    # creds.json or missing spreadsheet fails before any data is typed
+    get_sheet()
+    executor = ThreadPoolExecutor(max_workers=1)
+    # read the worksheets while the user is typing the sales data
+    prefetched = executor.submit(prefetch)
+    try:
+        sales_data = get_sales_data()
+    except BaseException:
+        # Ctrl-C or EOF at the prompt: don't wait for the read to finish
+        _aborted.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    sheet_data = prefetched.result()
+    executor.shutdown()
     update_worksheet(sales_data, "sales")
-    surplus_data = calculate_surplus_data(sales_data)
+    surplus_data = calculate_surplus_data(
+        sales_data, sheet_data["stock_last_row"]
+    )
     update_worksheet(surplus_data, "surplus")
-    sales_columns = get_last_5_entries_sales()
+    # the sales entries were read before the new sales row was appended
+    sales_columns = [
+        column[-4:] + [sales]
+        for column, sales in zip(sheet_data["sales_last5_cols"], sales_data)
+    ]
     stock_data = calculate_stock_data(sales_columns)
     update_worksheet(stock_data, "stock")
 
 
-print("Welcome to Love Sandwiches Data Automation")
-main()
+if __name__ == "__main__":
+    print("Welcome to Love Sandwiches Data Automation")
+    main()